@@ -1,21 +1,29 @@
 #!/usr/bin/env python3
 """
-Scrap the issues of a GitHub project
+Scrap the issues and pull requests of a GitHub project
 """
 import argparse
-import json
+import asyncio
+import contextlib
+import hashlib
 import logging
 import os
+import random
 import re
 import sys
-from dataclasses import dataclass
+import time
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, BinaryIO, Dict, List, Mapping, Optional, Set
 
+import orjson
 from gql import Client, gql
+from gql.client import AsyncClientSession
 from gql.transport.aiohttp import AIOHTTPTransport
 from gql.transport.aiohttp import log as gql_transport_logger
+from gql.transport.exceptions import TransportServerError
+from graphql import DocumentNode, print_ast
 
 logger = logging.getLogger()
 
@@ -23,116 +31,544 @@ LOG_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
 
 SCHEMA_PATH = Path(__file__).parent / "github-schema.graphql"
 
-FORMAT_KEY = "_format"
-FORMAT = 2
+SINCE_RE = re.compile(r"(\d+)([wdh])")
+SINCE_UNITS = {"w": "weeks", "d": "days", "h": "hours"}
 
+# Wait for the rate limit to reset when there are less requests than this left
+RATE_LIMIT_LOW_WATER = 10
 
-@dataclass
-class ScrapInfo:
-    project: str
-    out_dir: Path
-    since: Optional[datetime]
+# How many times to send a query before giving up, when GitHub answers with a
+# rate-limit or server error
+MAX_ATTEMPTS = 5
 
+# Where to store the items of each connection of ITEMS_QUERY
+DIR_NAMES = {"issues": "issues", "pullRequests": "pulls"}
+CACHE_DIR_NAME = ".ghi-cache"
 
-def is_pull_request(dct: Dict[str, Any]) -> bool:
-    return "pull_request" in dct
+FORMAT_KEY = "_format"
+FORMAT = 3
 
+COMMENT_CONNECTION_FRAGMENT = """
+    fragment CommentConnectionFields on IssueCommentConnection {
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
+        edges {
+            node {
+                author {
+                    login
+                    url
+                }
+                createdAt
+                lastEditedAt
+                body
+            }
+        }
+    }
+"""
 
-def scrap_page(client: Client, info: ScrapInfo, cursor: str | None) -> str | None:
-    logger.info("Scraping page %s", cursor)
-    query = gql(
-        """
-        query($owner: String!, $name: String!, $since: DateTime, $issues_after: String) {
-            repository(owner: $owner, name: $name) {
-            issues(after: $issues_after, filterBy: { since: $since }, first: 20) {
-                    pageInfo {
-                        endCursor
-                        hasNextPage
+# Fields common to issues and pull requests
+ITEM_FIELDS = """
+    number
+    title
+    url
+    body
+    state
+    createdAt
+    updatedAt
+    author {
+        login
+        url
+    }
+    labels(first: 20) {
+        edges {
+            node {
+                name
+            }
+        }
+    }
+    comments(first: 100) {
+        ...CommentConnectionFields
+    }
+"""
+
+ITEM_FRAGMENTS = (
+    COMMENT_CONNECTION_FRAGMENT
+    + f"""
+    fragment IssueFields on Issue {{
+        {ITEM_FIELDS}
+    }}
+
+    fragment PullRequestFields on PullRequest {{
+        {ITEM_FIELDS}
+    }}
+"""
+)
+
+# Fetches a page of issues and a page of pull requests in the same request.
+# Once one of the connections has been fully fetched, it is skipped using the
+# $with_issues and $with_pulls variables.
+ITEMS_QUERY = gql(
+    ITEM_FRAGMENTS
+    + """
+    query(
+        $owner: String!,
+        $name: String!,
+        $since: DateTime,
+        $with_issues: Boolean!,
+        $issues_after: String,
+        $with_pulls: Boolean!,
+        $pulls_after: String,
+        $pulls_order_by: IssueOrder
+    ) {
+        repository(owner: $owner, name: $name) {
+            issues(after: $issues_after, filterBy: { since: $since }, first: 100)
+            @include(if: $with_issues) {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                edges {
+                    node {
+                        ...IssueFields
+                    }
+                }
+            }
+            pullRequests(after: $pulls_after, orderBy: $pulls_order_by, first: 100)
+            @include(if: $with_pulls) {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                edges {
+                    node {
+                        ...PullRequestFields
                     }
-                    edges {
-                        node {
-                            number
-                            title
-                            url
-                            body
-                            state
-                            createdAt
-                            updatedAt
-                            author {
-                                login
-                                url
-                            }
-                            labels(first: 20) {
-                                edges {
-                                    node {
-                                        name
-                                    }
-                                }
-                            }
-                            comments(first: 100) {
-                                edges {
-                                    node {
-                                        author {
-                                            login
-                                            url
-                                        }
-                                        createdAt
-                                        lastEditedAt
-                                        body
-                                    }
-                                }
-                            }
-                        }
+                }
+            }
+        }
+    }
+    """
+)
+
+# Used to fetch the comments of issues and pull requests with more comments
+# than what fits in ITEMS_QUERY
+COMMENTS_QUERY = gql(
+    COMMENT_CONNECTION_FRAGMENT
+    + """
+    query($owner: String!, $name: String!, $number: Int!, $comments_after: String) {
+        repository(owner: $owner, name: $name) {
+            issueOrPullRequest(number: $number) {
+                ... on Issue {
+                    comments(after: $comments_after, first: 100) {
+                        ...CommentConnectionFields
+                    }
+                }
+                ... on PullRequest {
+                    comments(after: $comments_after, first: 100) {
+                        ...CommentConnectionFields
                     }
                 }
             }
         }
-        """
-    )
+    }
+    """
+)
+
+
+@dataclass
+class ResultCache:
+    """Stores query results on disk, so that running the scraper again with the
+    same arguments shortly after does not send the same queries again"""
+
+    cache_dir: Path
+    ttl: float
+
+    def get(self, query: DocumentNode, params: Dict[str, Any]) -> Dict[str, Any] | None:
+        path = self._get_path(query, params)
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if time.time() - mtime > self.ttl:
+            return None
+        try:
+            return orjson.loads(path.read_bytes())
+        except orjson.JSONDecodeError:
+            logger.warning("Removing invalid cache entry %s", path)
+            path.unlink(missing_ok=True)
+            return None
+
+    def put(
+        self, query: DocumentNode, params: Dict[str, Any], result: Dict[str, Any]
+    ) -> None:
+        self.cache_dir.mkdir(exist_ok=True)
+        path = self._get_path(query, params)
+        # Write to a temporary file first, so that an interrupted run does not
+        # leave a truncated entry behind
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(orjson.dumps(result))
+        os.replace(tmp_path, path)
+
+    def remove_expired(self) -> None:
+        if not self.cache_dir.is_dir():
+            return
+        now = time.time()
+        # Also matches temporary files left behind by interrupted runs
+        for path in self.cache_dir.iterdir():
+            if now - path.stat().st_mtime > self.ttl:
+                path.unlink()
+
+    def _get_path(self, query: DocumentNode, params: Dict[str, Any]) -> Path:
+        key = hashlib.blake2b(print_ast(query).encode())
+        key.update(orjson.dumps(params, option=orjson.OPT_SORT_KEYS))
+        return self.cache_dir / f"{key.hexdigest()}.json"
+
+
+@dataclass
+class RateLimiter:
+    """Keeps track of the GitHub rate limit, to wait for it to reset instead of
+    running into it"""
+
+    low_water: int = RATE_LIMIT_LOW_WATER
+    remaining: Optional[int] = None
+    reset_time: float = 0
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None:
+            self.remaining = int(remaining)
+            logger.info("Rate limit: %d requests remaining", self.remaining)
+        reset_time = headers.get("X-RateLimit-Reset")
+        if reset_time is not None:
+            self.reset_time = float(reset_time)
+
+    async def wait(self) -> None:
+        if self.remaining is None or self.remaining >= self.low_water:
+            return
+        delay = self.reset_time - time.time()
+        if delay > 0:
+            logger.warning(
+                "Only %d requests remaining, waiting %.1f seconds for the rate limit to reset",
+                self.remaining,
+                delay,
+            )
+            await asyncio.sleep(delay)
+        self.remaining = None
+
+
+def get_retry_delay(exc: TransportServerError, attempt: int) -> float | None:
+    """Returns how long to wait before sending a query which failed with `exc`
+    again, or None if it should not be retried"""
+    if exc.code is None or not (exc.code in (403, 429) or exc.code >= 500):
+        return None
+
+    # The transport raises TransportServerError from aiohttp's exception,
+    # which holds the response headers
+    headers = getattr(exc.__cause__, "headers", None) or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        return float(retry_after)
+
+    # Primary rate limit: wait for it to reset
+    rate_limited = headers.get("X-RateLimit-Remaining") == "0"
+    reset_time = headers.get("X-RateLimit-Reset")
+    if rate_limited and reset_time is not None:
+        return max(0, float(reset_time) - time.time())
+
+    # Any other 403 is an actual error, such as a permission error
+    if exc.code == 403 and not rate_limited:
+        return None
+    return 0.5 * 2**attempt + random.uniform(0, 0.5)
+
+
+@dataclass
+class ScrapInfo:
+    project: str
+    out_dir: Path
+    since: Optional[datetime]
+    pretty: bool
+    aggregate: bool = False
+    cache: Optional[ResultCache] = None
+    rate_limiter: RateLimiter = field(default_factory=RateLimiter)
+
+
+async def execute(
+    session: AsyncClientSession,
+    info: ScrapInfo,
+    query: DocumentNode,
+    params: Dict[str, Any],
+) -> Dict[str, Any]:
+    cache = info.cache
+    if cache is not None:
+        result = cache.get(query, params)
+        if result is not None:
+            logger.info("Using cached result")
+            return result
+
+    rate_limiter = info.rate_limiter
+    attempt = 0
+    while True:
+        await rate_limiter.wait()
+        try:
+            result = await session.execute(query, variable_values=params)
+            break
+        except TransportServerError as exc:
+            attempt += 1
+            delay = get_retry_delay(exc, attempt)
+            if delay is None or attempt == MAX_ATTEMPTS:
+                raise
+            logger.warning("%s, retrying in %.1f seconds", exc, delay)
+            await asyncio.sleep(delay)
+
+    transport = session.transport
+    if isinstance(transport, AIOHTTPTransport) and transport.response_headers:
+        rate_limiter.update(transport.response_headers)
+
+    # Store the result before the caller modifies it
+    if cache is not None:
+        cache.put(query, params, result)
+    return result
+
+
+def parse_github_date(text: str) -> datetime:
+    # datetime.fromisoformat() does not support the "Z" suffix before Python 3.11
+    return datetime.fromisoformat(text.replace("Z", "+00:00"))
+
+
+async def fetch_page(
+    session: AsyncClientSession, info: ScrapInfo, cursors: Dict[str, str | None]
+) -> Dict[str, Any]:
+    """Fetch the next page of the connections listed in `cursors`. Returns a
+    dict containing one connection for each key of `cursors`"""
+    logger.info("Scraping page %s", cursors)
 
     owner, name = info.project.split("/")
 
+    if info.since:
+        # pullRequests() cannot be filtered by update date, so sort them by
+        # update date to be able to stop at the first one older than `since`.
+        # A pull request updated during the run moves to the front and shifts
+        # the following pages, so one pull request can be skipped: the next
+        # run picks it up.
+        pulls_order_by = {"field": "UPDATED_AT", "direction": "DESC"}
+    else:
+        pulls_order_by = {"field": "CREATED_AT", "direction": "ASC"}
+
     params = {
         "owner": owner,
         "name": name,
         "since": info.since.isoformat() if info.since else None,
-        "issues_after": cursor,
+        "with_issues": "issues" in cursors,
+        "issues_after": cursors.get("issues"),
+        "with_pulls": "pullRequests" in cursors,
+        "pulls_after": cursors.get("pullRequests"),
+        "pulls_order_by": pulls_order_by,
     }
 
-    result = client.execute(query, variable_values=params)
+    result = await execute(session, info, ITEMS_QUERY, params)
+    connections = result["repository"]
+
+    pulls = connections.get("pullRequests")
+    since = info.since
+    if pulls is not None and since:
+        edges = pulls["edges"]
+        pulls["edges"] = [
+            x for x in edges if parse_github_date(x["node"]["updatedAt"]) >= since
+        ]
+        if len(pulls["edges"]) < len(edges):
+            # Next pages only contain older pull requests
+            pulls["pageInfo"]["hasNextPage"] = False
+
+    # Fetch the missing comments one item at a time: threads longer than a
+    # page are rare, and firing all the queries at once could trigger GitHub's
+    # secondary rate limits
+    for connection in connections.values():
+        for edge in connection["edges"]:
+            await fetch_remaining_comments(session, info, edge["node"])
+    return connections
+
+
+async def fetch_remaining_comments(
+    session: AsyncClientSession, info: ScrapInfo, dct: Dict[str, Any]
+) -> None:
+    """Complete the comments of an item returned by ITEMS_QUERY and remove
+    their pagination info, which we do not store"""
+    comments = dct["comments"]
+    page_info = comments.pop("pageInfo")
+    if not page_info["hasNextPage"]:
+        return
+
+    owner, name = info.project.split("/")
+    item_id = dct["number"]
+    cursor = page_info["endCursor"]
+    while cursor is not None:
+        logger.info("Scraping comments of #%d, page %s", item_id, cursor)
+        params = {
+            "owner": owner,
+            "name": name,
+            "number": item_id,
+            "comments_after": cursor,
+        }
+        result = await execute(session, info, COMMENTS_QUERY, params)
+        page = result["repository"]["issueOrPullRequest"]["comments"]
+        comments["edges"].extend(page["edges"])
+        page_info = page["pageInfo"]
+        cursor = page_info["endCursor"] if page_info["hasNextPage"] else None
+
+
+def is_up_to_date(path: Path, dct: Dict[str, Any], pretty: bool) -> bool:
+    """Returns True if `path` already contains the version of the item
+    described by `dct`, in the layout selected by `pretty`"""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return False
+    # Pretty files start with "{\n", compact ones with '{"'
+    if data.startswith(b"{\n") != pretty:
+        return False
+    try:
+        existing = orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return False
+    return (
+        existing.get(FORMAT_KEY) == FORMAT
+        and existing.get("updatedAt") == dct["updatedAt"]
+    )
 
-    edges = result["repository"]["issues"]["edges"]
-    page_info = result["repository"]["issues"]["pageInfo"]
+
+def find_up_to_date_items(
+    item_dir: Path, edges: List[Dict[str, Any]], pretty: bool
+) -> Set[int]:
+    ids = set()
+    for edge in edges:
+        dct = edge["node"]
+        item_id = dct["number"]
+        if is_up_to_date(item_dir / f"{item_id}.json", dct, pretty):
+            ids.add(item_id)
+    return ids
+
+
+def write_files(
+    paths: List[Path], items: List[Dict[str, Any]], dump_options: int | None
+) -> None:
+    for path, dct in zip(paths, items):
+        path.write_bytes(orjson.dumps(dct, option=dump_options))
+
+
+async def write_page(
+    info: ScrapInfo, sub_dir: str, edges: List[Dict[str, Any]]
+) -> None:
+    item_dir = info.out_dir / sub_dir
+
+    if info.pretty:
+        dump_options = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+    else:
+        dump_options = None
+
+    # Do not rewrite files which have not changed, to avoid useless writes and
+    # keep their modification time meaningful
+    up_to_date_ids = await asyncio.to_thread(
+        find_up_to_date_items, item_dir, edges, info.pretty
+    )
+
+    paths = []
+    items = []
     for edge in edges:
         dct = edge["node"]
-        dct[FORMAT_KEY] = FORMAT
-        sub_dir = "issues"
-        item_dir = info.out_dir / sub_dir
-        item_dir.mkdir(exist_ok=True)
         item_id = dct["number"]
-        item_path = item_dir / f"{item_id}.json"
+        if item_id in up_to_date_ids:
+            continue
+        dct[FORMAT_KEY] = FORMAT
+        logger.info("%s #%d: %s", sub_dir, item_id, dct["title"])
+
+        paths.append(item_dir / f"{item_id}.json")
+        items.append(dct)
 
-        text = json.dumps(dct, indent=2, sort_keys=True)
-        logging.info("%s #%d: %s", sub_dir, item_id, dct["title"])
-        item_path.write_text(text)
+    # Serialize and write the whole page from a worker thread, so that the
+    # event loop can make progress on the next page request meanwhile
+    await asyncio.to_thread(write_files, paths, items, dump_options)
 
-    if page_info["hasNextPage"]:
-        return page_info["endCursor"]
-    return None
+    if up_to_date_ids:
+        logger.info("%d %s already up to date", len(up_to_date_ids), sub_dir)
 
 
-def scrap(client: Client, info: ScrapInfo) -> None:
+def append_lines(fp: BinaryIO, items: List[Dict[str, Any]]) -> None:
+    # Gather the page in a single buffer, to append it with one write
+    buf = bytearray()
+    for dct in items:
+        buf += orjson.dumps(dct, option=orjson.OPT_APPEND_NEWLINE)
+    fp.write(buf)
+    fp.flush()
+
+
+async def append_page(
+    info: ScrapInfo, fp: BinaryIO, sub_dir: str, edges: List[Dict[str, Any]]
+) -> None:
+    """Aggregate mode counterpart of write_page(): append the items as JSON
+    lines to `fp`"""
+    items = []
+    for edge in edges:
+        dct = edge["node"]
+        dct[FORMAT_KEY] = FORMAT
+        logger.info("%s #%d: %s", sub_dir, dct["number"], dct["title"])
+        items.append(dct)
+
+    # scrap() waits for each page to be written before handling the next
+    # one, so there is never more than one thread writing to `fp`
+    await asyncio.to_thread(append_lines, fp, items)
+
+
+async def scrap(client: Client, info: ScrapInfo) -> None:
     if info.since:
         logger.info(
-            "Starting, scraping all issues for %s since %s", info.project, info.since
+            "Starting, scraping all issues and pull requests for %s since %s",
+            info.project,
+            info.since,
         )
     else:
-        logger.info("Starting, scraping issues for %s", info.project)
-    cursor = None
-    while True:
-        cursor = scrap_page(client, info, cursor)
-        if cursor is None:
-            return
+        logger.info("Starting, scraping issues and pull requests for %s", info.project)
+
+    with contextlib.ExitStack() as stack:
+        jsonl_files: Dict[str, BinaryIO] = {}
+        for sub_dir in DIR_NAMES.values():
+            if info.aggregate:
+                jsonl_path = info.out_dir / f"{sub_dir}.jsonl"
+                jsonl_files[sub_dir] = stack.enter_context(jsonl_path.open("ab"))
+            else:
+                (info.out_dir / sub_dir).mkdir(exist_ok=True)
+
+        # Keep a single session open for the whole run so that the underlying
+        # aiohttp connection is reused from one page to the next
+        async with client as session:
+            cursors: Dict[str, str | None] = {x: None for x in DIR_NAMES}
+            next_task = asyncio.create_task(fetch_page(session, info, cursors))
+            while next_task is not None:
+                connections = await next_task
+                cursors = {
+                    key: connection["pageInfo"]["endCursor"]
+                    for key, connection in connections.items()
+                    if connection["pageInfo"]["hasNextPage"]
+                }
+                if cursors:
+                    # Request the next page before writing this one, so that the
+                    # network round-trip overlaps with the disk writes
+                    next_task = asyncio.create_task(fetch_page(session, info, cursors))
+                else:
+                    next_task = None
+
+                for key, connection in connections.items():
+                    if not connection["edges"]:
+                        # Nothing to write, do not wake up the writer thread
+                        continue
+                    sub_dir = DIR_NAMES[key]
+                    if info.aggregate:
+                        await append_page(
+                            info, jsonl_files[sub_dir], sub_dir, connection["edges"]
+                        )
+                    else:
+                        await write_page(info, sub_dir, connection["edges"])
 
 
 def setup_logger():
@@ -142,26 +578,25 @@ def setup_logger():
 
 
 def parse_since(since: str) -> datetime:
+    """Returns a timezone-aware datetime, so that its ISO8601 form, sent to
+    GitHub, refers to the same instant as the one used to filter pull requests"""
+    # Check for relative dates first: they are the common case and cannot be
+    # mistaken for an ISO8601 date
+    match = SINCE_RE.fullmatch(since)
+    if match:
+        value = int(match.group(1))
+        unit = SINCE_UNITS[match.group(2)]
+        # Round to the minute, so that running again shortly after uses the
+        # same date, and can reuse cached results
+        now = datetime.now().astimezone().replace(second=0, microsecond=0)
+        return now - timedelta(**{unit: value})
+
     try:
-        return datetime.fromisoformat(since)
+        date = datetime.fromisoformat(since)
     except ValueError:
-        pass
-    match = re.fullmatch(r"(\d+)([wdh])", since)
-    if not match:
         sys.exit(f"'{since}' is not a valid date")
-
-    value = int(match.group(1))
-    unit = match.group(2)
-    if unit == "w":
-        delta = timedelta(weeks=value)
-    elif unit == "d":
-        delta = timedelta(days=value)
-    elif unit == "h":
-        delta = timedelta(hours=value)
-    else:
-        raise NotImplementedError
-
-    return datetime.now() - delta
+    # Dates without a timezone are in local time
+    return date.astimezone()
 
 
 def create_client(github_token: str) -> Client:
@@ -181,9 +616,27 @@ def main() -> int:
 
     parser.add_argument(
         "--since",
-        help="Import issues updated since DATE. Date can be either an ISO8601 date or a number followed by 'w', 'd', 'h' (weeks, days, hours)",
+        help="Import issues and pull requests updated since DATE. Date can be either an ISO8601 date or a number followed by 'w', 'd', 'h' (weeks, days, hours)",
         metavar="DATE",
     )
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument(
+        "--pretty",
+        action="store_true",
+        help="Indent the JSON files and sort their keys",
+    )
+    format_group.add_argument(
+        "--aggregate",
+        action="store_true",
+        help="Append the issues and pull requests to OUT_DIR/issues.jsonl and OUT_DIR/pulls.jsonl, one per line, instead of writing one file per item. Every fetched item is appended, even if it has not changed: use --since for repeated runs",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=0,
+        help=f"Cache query results in OUT_DIR/{CACHE_DIR_NAME} for SECONDS, to avoid sending the same queries again when running the scraper several times in a row (default: no caching)",
+        metavar="SECONDS",
+    )
     parser.add_argument("project", help="Project as a OWNER/REPO format")
     parser.add_argument("out_dir", help="Where to write the JSON files")
 
@@ -206,8 +659,20 @@ def main() -> int:
         since = parse_since(args.since)
     else:
         since = None
-    scrap_info = ScrapInfo(args.project, out_dir, since)
-    scrap(client, scrap_info)
+    if args.cache_ttl > 0:
+        cache = ResultCache(out_dir / CACHE_DIR_NAME, args.cache_ttl)
+        cache.remove_expired()
+    else:
+        cache = None
+    scrap_info = ScrapInfo(
+        args.project,
+        out_dir,
+        since,
+        pretty=args.pretty,
+        aggregate=args.aggregate,
+        cache=cache,
+    )
+    asyncio.run(scrap(client, scrap_info))
 
     return 0
 